@@ -1,10 +1,33 @@
+import asyncio
+import atexit
+import bisect
+import collections
+import copy
+import functools
+import hmac
+import html
 import logging
 import os
+import queue
+import random
+import re
+import signal
+import time as time_module
+from http import HTTPStatus
+from logging.handlers import QueueHandler, QueueListener
+import httpx
+import tornado.web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, User
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, JobQueue, CallbackContext 
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, JobQueue, CallbackContext, TypeHandler
 from datetime import time, timedelta, timezone, datetime 
 import json 
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
+import numpy as np
+try:
+    from pythonjsonlogger.json import JsonFormatter
+except ImportError:  # python-json-logger < 3.1
+    from pythonjsonlogger.jsonlogger import JsonFormatter
 
 # --- Configuration (MUST BE SET) ---
 # 1. BOT TOKEN: Loaded from Render Environment Variable (Secret).
@@ -15,13 +38,53 @@ TARGET_CHAT_ID_RAW = os.environ.get("TARGET_CHAT_ID", "-1003197836887")
 # --- Time Constants (GMT+5/UTC+5 Time Zone) ---
 KAZAKHSTAN_TZ = timezone(timedelta(hours=5)) # UTC+5 Time Zone
 
+class SystemClock:
+    """Wall clock in UTC+5. All schedule and expiry logic reads the time through the module-level `clock`."""
+    def now(self) -> datetime:
+        return datetime.now(KAZAKHSTAN_TZ)
+
+class VirtualClock:
+    """Manually advanced clock, swapped in for `clock` by the schedule simulation (simulate.py)."""
+    def __init__(self, start: datetime):
+        self.current = start
+
+    def now(self) -> datetime:
+        return self.current
+
+    def set(self, moment: datetime):
+        self.current = moment
+
+clock = SystemClock()
+
 # Scheduled times: Monday to Friday
 POLL_START_TIME = time(8, 0, 0, tzinfo=KAZAKHSTAN_TZ)   # Poll starts at 08:00 AM UTC+5
 POLL_END_TIME = time(11, 00, 0, tzinfo=KAZAKHSTAN_TZ) # Poll closes at 10:30 AM UTC+5
 
+# Warm-up runs this many minutes before POLL_START_TIME (must stay below BOT_HTTP_KEEPALIVE_SECONDS)
+PREWARM_LEAD_MINUTES = int(os.environ.get("PREWARM_LEAD_MINUTES", 2))
+PREWARM_TIME = (datetime.combine(datetime(2000, 1, 3).date(), POLL_START_TIME) - timedelta(minutes=PREWARM_LEAD_MINUTES)).timetz()
+
+# --- Outbound HTTP (Bot API client) ---
+BOT_HTTP_POOL_SIZE = int(os.environ.get("BOT_HTTP_POOL_SIZE", 32))
+# Idle connections are kept open this long; httpx's default of 5s drops them between bursts
+BOT_HTTP_KEEPALIVE_SECONDS = float(os.environ.get("BOT_HTTP_KEEPALIVE_SECONDS", 600))
+BOT_HTTP_VERSION = os.environ.get("BOT_HTTP_VERSION", "1.1") # "2" needs python-telegram-bot[http2]
+BOT_HTTP_CONNECT_TIMEOUT = float(os.environ.get("BOT_HTTP_CONNECT_TIMEOUT", 5.0))
+BOT_HTTP_READ_TIMEOUT = float(os.environ.get("BOT_HTTP_READ_TIMEOUT", 5.0))
+BOT_HTTP_WRITE_TIMEOUT = float(os.environ.get("BOT_HTTP_WRITE_TIMEOUT", 5.0))
+BOT_HTTP_POOL_TIMEOUT = float(os.environ.get("BOT_HTTP_POOL_TIMEOUT", 1.0))
+# Number of parallel requests used to open pooled connections during warm-up
+PREWARM_CONNECTIONS = int(os.environ.get("PREWARM_CONNECTIONS", 4))
+
 # --- RENDER ENVIRONMENT VARS ---
 PORT = int(os.environ.get("PORT", 8080))
 RENDER_EXTERNAL_URL = os.environ.get("RENDER_EXTERNAL_URL", "YOUR_RENDER_URL_HERE") 
+# Seconds allowed for draining in-flight updates and jobs on SIGTERM before giving up
+SHUTDOWN_TIMEOUT_SECONDS = float(os.environ.get("SHUTDOWN_TIMEOUT_SECONDS", 20))
+# How long the webhook holds a callback query's HTTP response waiting for its answer
+INLINE_ANSWER_TIMEOUT_SECONDS = float(os.environ.get("INLINE_ANSWER_TIMEOUT_SECONDS", 0.8))
+# Token for the read-only results API (/api/...). The API is disabled when unset.
+API_TOKEN = os.environ.get("API_TOKEN")
 
 # --- Bot Strings (Kazakh Language) ---
 POLL_QUESTION = "Сіз түскі ас ішесіз бе?"
@@ -59,6 +122,8 @@ USAGE_LIMIT_EXCEEDED = "❌ Сіз бүгінгі `/poll` пәрменін қо
 CONFIRMATION_MESSAGE = "⚠️ *Назар аударыңыз:* Бүгінгі дауыс беру қазір белсенді.\n\nСіз қайта бастағыңыз келе ме? Егер *Иә* десеңіз, *барлық ағымдағы дауыстар жойылады*."
 RESTART_CONFIRMED = "✅ *Дауыс беру сәтті қайта басталды!* Бұрынғы дауыстар жойылды."
 RESTART_CANCELED = "❌ *Қайта бастаудан бас тартылды.* Ағымдағы дауыстар сақталды."
+REMINDER_HEADER = f"⏰ <b>Еске салу:</b> дауыс беру сағат {POLL_END_TIME.strftime('%H:%M')}-де аяқталады. Әлі дауыс бермегендер:\n"
+FORECAST_LINE = "📈 Болжам: шамамен *{}* адам түскі ас ішеді."
 
 # Global variable to hold the integer chat ID, initialized in main()
 TARGET_CHAT_ID = None 
@@ -67,72 +132,446 @@ TARGET_CHAT_ID = None
 STATE_FILE = "poll_state.json" 
 PAST_POLLS_FILE = "past_polls.json"
 POLL_USAGE_FILE = "poll_usage.json" # New file for tracking daily /poll usage
+USER_DIRECTORY_FILE = "user_directory.json" # Names of users seen in incoming updates
+CHAT_ROSTER_FILE = "chat_roster.json" # Known members of the target chat
+
+# --- User Directory Settings ---
+USER_DIRECTORY_FLUSH_SECONDS = int(os.environ.get("USER_DIRECTORY_FLUSH_SECONDS", 300))
+USER_LOOKUP_CONCURRENCY = int(os.environ.get("USER_LOOKUP_CONCURRENCY", 5))
+
+# --- Non-Voter Reminder Settings ---
+# Reminder is sent this many minutes before POLL_END_TIME (0 disables it)
+REMINDER_LEAD_MINUTES = int(os.environ.get("REMINDER_LEAD_MINUTES", 30))
+REMINDER_TIME = (datetime.combine(datetime(2000, 1, 3).date(), POLL_END_TIME) - timedelta(minutes=REMINDER_LEAD_MINUTES)).timetz()
+REMINDER_MENTIONS_PER_MESSAGE = int(os.environ.get("REMINDER_MENTIONS_PER_MESSAGE", 50))
+MAX_MESSAGE_LENGTH = 4096 # Telegram's limit for message text
+
+# --- Poll State ---
+class PollState:
+    """
+    In-memory state of the current poll.
+    Votes live in a single user_id -> is_yes map, and the yes/no tallies are
+    maintained on every change instead of being recounted. The live poll keeps
+    no per-voter names: display names come from the user directory. Archived
+    polls, whose names are frozen, carry their own `names` map instead.
+    """
+    __slots__ = ('is_active', 'poll_message_id', 'target_chat_id', 'lunch_date', 'is_manual', 'votes', 'names', 'stored_names', 'yes_count', 'no_count', 'revision')
+
+    # Version 1 is the legacy layout with separate 'yes_voters'/'no_voters' name maps.
+    SCHEMA_VERSION = 2
+
+    def __init__(self, target_chat_id=None):
+        self.is_active = False
+        self.poll_message_id = None
+        self.target_chat_id = target_chat_id
+        self.lunch_date = None
+        self.is_manual = False
+        self.votes = {}
+        # None means "look names up in the user directory"
+        self.names = None
+        # Display names from poll_state.json for voters missing from the directory.
+        # Used for display only; never treated as directory (full name) data.
+        self.stored_names = {}
+        self.yes_count = 0
+        self.no_count = 0
+        # In-process change counter (bumped on every save), used for HTTP ETags. Not persisted.
+        self.revision = 0
+
+    @property
+    def total_votes(self) -> int:
+        return self.yes_count + self.no_count
+
+    def reset(self, lunch_date: str, is_manual: bool):
+        """Activates a fresh poll for the given date, dropping all votes."""
+        self.is_active = True
+        self.poll_message_id = None
+        self.lunch_date = lunch_date
+        self.is_manual = is_manual
+        self.votes = {}
+        self.stored_names = {}
+        self.yes_count = 0
+        self.no_count = 0
+
+    def has_voted(self, user_id: int) -> bool:
+        return user_id in self.votes
+
+    def cast_vote(self, user_id: int, is_yes: bool) -> Optional[bool]:
+        """
+        Records a vote ("last vote counts") and keeps the tallies in sync.
+        Returns the user's previous vote (None if this is their first vote).
+        A repeated identical vote leaves the state untouched.
+        """
+        previous_vote = self.votes.get(user_id)
+        if previous_vote is is_yes:
+            return previous_vote
+
+        self.votes[user_id] = is_yes
+        if is_yes:
+            self.yes_count += 1
+            if previous_vote is not None:
+                self.no_count -= 1
+        else:
+            self.no_count += 1
+            if previous_vote is not None:
+                self.yes_count -= 1
+        return previous_vote
+
+    def display_name(self, user_id: int) -> str:
+        if self.names is not None:
+            return self.names.get(user_id, str(user_id))
+        return get_directory_name(user_id) or self.stored_names.get(user_id) or str(user_id)
+
+    def voters(self, is_yes: bool) -> Dict[int, str]:
+        """Returns a user_id -> display name map of everyone who voted is_yes."""
+        return {uid: self.display_name(uid) for uid, vote in self.votes.items() if vote is is_yes}
+
+    def to_api_dict(self) -> Dict[str, Any]:
+        """Public JSON view of the tallies for the results API."""
+        return {
+            'lunch_date': self.lunch_date,
+            'is_active': self.is_active,
+            'is_manual': self.is_manual,
+            'yes_count': self.yes_count,
+            'no_count': self.no_count,
+            'total_votes': self.total_votes,
+            'yes_voters': list(self.voters(True).values()),
+            'no_voters': list(self.voters(False).values()),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Compact, versioned representation for poll_state.json.
+        Display names are written alongside the votes so the file stays
+        self-contained even if the lazily saved user directory is behind.
+        """
+        return {
+            'v': self.SCHEMA_VERSION,
+            'active': self.is_active,
+            'msg': self.poll_message_id,
+            'chat': self.target_chat_id,
+            'date': self.lunch_date,
+            'manual': self.is_manual,
+            'votes': [[uid, int(vote), self.display_name(uid)] for uid, vote in self.votes.items()],
+        }
+
+    def load_dict(self, data: Dict[str, Any]):
+        """
+        Replaces the state with the contents of a to_dict() payload.
+        Also accepts the legacy (version 1) layout. The configured target chat
+        is kept when the stored payload does not carry one. Stored names of
+        users missing from the user directory are kept for display only.
+        """
+        if data.get('v', 1) >= 2:
+            self.is_active = bool(data.get('active', False))
+            self.poll_message_id = data.get('msg')
+            chat_id = data.get('chat')
+            self.lunch_date = data.get('date')
+            self.is_manual = bool(data.get('manual', False))
+            stored_votes = [(int(uid), bool(vote), name) for uid, vote, name in data.get('votes', [])]
+        else:
+            self.is_active = bool(data.get('is_active', False))
+            self.poll_message_id = data.get('poll_message_id')
+            chat_id = data.get('target_chat_id')
+            self.lunch_date = data.get('lunch_date')
+            self.is_manual = bool(data.get('is_manual', False))
+            stored_votes = [(int(uid), True, name) for uid, name in data.get('yes_voters', {}).items()]
+            stored_votes += [(int(uid), False, name) for uid, name in data.get('no_voters', {}).items()]
+
+        if chat_id is not None:
+            self.target_chat_id = int(chat_id)
+        self.votes = {uid: vote for uid, vote, _ in stored_votes}
+        if self.names is not None:
+            self.names.update((uid, name) for uid, _, name in stored_votes)
+        else:
+            self.stored_names = {uid: name for uid, _, name in stored_votes if name and uid not in user_directory}
+        self.yes_count = sum(self.votes.values())
+        self.no_count = len(self.votes) - self.yes_count
+
+    @classmethod
+    def from_archive(cls, archived_poll: Dict[str, Any], lunch_date: str) -> 'PollState':
+        """Builds a read-only view of an archived poll (past_polls.json entry)."""
+        state = cls()
+        state.names = {}
+        state.load_dict({
+            'yes_voters': archived_poll.get('yes_voters', {}),
+            'no_voters': archived_poll.get('no_voters', {}),
+            'lunch_date': lunch_date,
+            'is_manual': archived_poll.get('is_manual', False),
+        })
+        return state
+
+    def to_archive(self, end_time: str, status: str, names: Optional[Dict[int, str]] = None) -> Dict[str, Any]:
+        """
+        Builds the past_polls.json entry for this poll.
+        names optionally overrides the display names per user_id.
+        """
+        names = names or {}
+        yes_voters = {}
+        no_voters = {}
+        for uid, vote in self.votes.items():
+            (yes_voters if vote else no_voters)[uid] = names.get(uid) or self.display_name(uid)
+        return {
+            'yes_voters': yes_voters,
+            'no_voters': no_voters,
+            'end_time': end_time,
+            'status': status,
+            'is_manual': self.is_manual,
+        }
+
+
+# --- Attendance Forecast ---
+# Recency weighting: a day's weight halves every FORECAST_HALF_LIFE_DAYS days
+FORECAST_HALF_LIFE_DAYS = float(os.environ.get("FORECAST_HALF_LIFE_DAYS", 28))
+# Extra weight for archived days that fall on the same weekday as the forecast day
+FORECAST_WEEKDAY_WEIGHT = float(os.environ.get("FORECAST_WEEKDAY_WEIGHT", 2.0))
+
+class AttendanceMatrix:
+    """
+    User x date matrix of archived votes: 1.0 = yes, 0.0 = no, NaN = did not vote.
+    Built once from past_polls and then updated one day at a time as polls are archived.
+    """
+    __slots__ = ('user_ids', 'user_index', 'names', 'dates', 'ordinals', 'votes')
+
+    def __init__(self):
+        self.user_ids = []
+        self.user_index = {}
+        self.names = {}
+        self.dates = []
+        self.ordinals = np.empty(0, dtype=np.int64)
+        self.votes = np.empty((0, 0), dtype=np.float32)
+
+    @classmethod
+    def from_past_polls(cls, past_polls: Dict[str, Dict[str, Any]]) -> 'AttendanceMatrix':
+        matrix = cls()
+        matrix.dates = sorted(past_polls)
+        matrix.ordinals = np.array(
+            [datetime.strptime(d, '%Y-%m-%d').toordinal() for d in matrix.dates], dtype=np.int64
+        )
+        for d in matrix.dates:
+            for voters in (past_polls[d].get('yes_voters', {}), past_polls[d].get('no_voters', {})):
+                for uid, name in voters.items():
+                    matrix._ensure_user(int(uid), name, grow=False)
+
+        matrix.votes = np.full((len(matrix.user_ids), len(matrix.dates)), np.nan, dtype=np.float32)
+        for col, d in enumerate(matrix.dates):
+            matrix._fill_column(col, past_polls[d])
+        return matrix
+
+    def _ensure_user(self, user_id: int, name: str, grow: bool = True):
+        self.names[user_id] = name
+        if user_id in self.user_index:
+            return
+        self.user_index[user_id] = len(self.user_ids)
+        self.user_ids.append(user_id)
+        if grow:
+            new_row = np.full((1, self.votes.shape[1]), np.nan, dtype=np.float32)
+            self.votes = np.vstack([self.votes, new_row])
+
+    def _fill_column(self, col: int, archived_poll: Dict[str, Any]):
+        self.votes[:, col] = np.nan
+        for uid in archived_poll.get('yes_voters', {}):
+            self.votes[self.user_index[int(uid)], col] = 1.0
+        for uid in archived_poll.get('no_voters', {}):
+            self.votes[self.user_index[int(uid)], col] = 0.0
+
+    def add_day(self, date_str: str, archived_poll: Dict[str, Any]):
+        """Adds or replaces the column for one archived day."""
+        for voters in (archived_poll.get('yes_voters', {}), archived_poll.get('no_voters', {})):
+            for uid, name in voters.items():
+                self._ensure_user(int(uid), name)
+
+        col = bisect.bisect_left(self.dates, date_str)
+        if col == len(self.dates) or self.dates[col] != date_str:
+            self.dates.insert(col, date_str)
+            self.ordinals = np.insert(self.ordinals, col, datetime.strptime(date_str, '%Y-%m-%d').toordinal())
+            self.votes = np.insert(self.votes, col, np.nan, axis=1)
+        self._fill_column(col, archived_poll)
+
+    def remove_day(self, date_str: str):
+        """Drops the column for one day (e.g. after /deletehistory)."""
+        col = bisect.bisect_left(self.dates, date_str)
+        if col < len(self.dates) and self.dates[col] == date_str:
+            self.dates.pop(col)
+            self.ordinals = np.delete(self.ordinals, col)
+            self.votes = np.delete(self.votes, col, axis=1)
+
+    def forecast(self, target_date) -> Tuple[float, Dict[int, float]]:
+        """
+        Predicts the "yes" count for target_date and each user's "yes" likelihood.
+        A user's likelihood is their recency- and weekday-weighted "yes" rate over
+        the archived days since they first voted; not voting counts as not eating.
+        Only days before target_date are used.
+        """
+        if not self.user_ids or not self.dates:
+            return 0.0, {}
+
+        age_days = target_date.toordinal() - self.ordinals
+        weights = 0.5 ** (age_days / FORECAST_HALF_LIFE_DAYS)
+        same_weekday = (self.ordinals - 1) % 7 == target_date.weekday()
+        weights = np.where(same_weekday, weights * FORECAST_WEEKDAY_WEIGHT, weights)
+        weights = np.where(age_days > 0, weights, 0.0)
+
+        observed = ~np.isnan(self.votes)
+        enrolled = np.logical_or.accumulate(observed, axis=1)
+        yes = np.where(observed, self.votes, 0.0)
+
+        weighted_yes = yes @ weights
+        weighted_days = enrolled @ weights
+        likelihoods = np.divide(weighted_yes, weighted_days, out=np.zeros_like(weighted_yes), where=weighted_days > 0)
+
+        return float(likelihoods.sum()), dict(zip(self.user_ids, likelihoods.tolist()))
+
 
 # --- Global State ---
-poll_state = {
-    'is_active': False,
-    'yes_voters': {}, 
-    'no_voters': {},  
-    'poll_message_id': None,
-    'target_chat_id': None, 
-    'lunch_date': None,       
-    'is_manual': False, 
-}
+poll_state = PollState()
+# user_id -> {'first_name', 'last_name', 'username', 'last_seen'}, filled passively from updates
+user_directory: Dict[int, Dict[str, Any]] = {}
+user_directory_dirty = False
+# user_ids of (non-bot) members of the target chat, from member updates and observed senders
+chat_roster: set = set()
+chat_roster_dirty = False
+# In-memory copy of past_polls.json for the results API, kept current by save_past_polls()
+past_polls_cache: Dict[str, Dict[str, Any]] = {}
+past_polls_revision = 0
+# Built lazily from past_polls_cache on the first forecast, then updated per archived day
+attendance_matrix: Optional[AttendanceMatrix] = None
+# Cleared at shutdown so the webhook asks Telegram to redeliver instead of queueing new updates
+accepting_updates = True
+# callback_query_id -> future resolved with the answerCallbackQuery payload while the webhook request is still open
+pending_inline_answers: Dict[str, asyncio.Future] = {}
+# How callback queries were answered: 'inline' (in the webhook response) or 'api' (separate request)
+callback_answer_stats = collections.Counter()
 
 # --- Logging Setup ---
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
-)
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Share of callback-query (vote) updates whose per-update detail is logged.
+VOTE_LOG_SAMPLE_RATE = float(os.environ.get("VOTE_LOG_SAMPLE_RATE", "0.05"))
+# Handlers slower than this are always logged, regardless of sampling.
+SLOW_HANDLER_SECONDS = float(os.environ.get("SLOW_HANDLER_SECONDS", "1.0"))
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Merges the %-style arguments into the message in the calling thread, so
+    mutable arguments (e.g. library objects) are rendered as they were when
+    logged, but leaves traceback formatting and JSON encoding to the listener
+    thread. The queue is in-process, so exc_info needs no pickling.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging() -> QueueListener:
+    """
+    Routes all logging through a queue to a background JSON writer.
+    Returns the started listener; it is stopped at interpreter exit.
+    """
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter(
+        '%(asctime)s %(name)s %(levelname)s %(message)s',
+        rename_fields={'levelname': 'level'},
+    ))
+
+    log_queue = queue.SimpleQueue()
+    root_logger = logging.getLogger()
+    root_logger.handlers.clear()
+    root_logger.addHandler(DeferredQueueHandler(log_queue))
+    root_logger.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+def update_log_fields(update: Optional[Update]) -> Dict[str, Any]:
+    """Extracts the structured identifiers of an update for log records."""
+    if update is None:
+        return {}
+    fields = {'update_id': update.update_id}
+    if update.effective_chat:
+        fields['chat_id'] = update.effective_chat.id
+    if update.effective_user:
+        fields['user_id'] = update.effective_user.id
+    if update.callback_query:
+        fields['callback_data'] = update.callback_query.data
+    return fields
+
+# Handlers and jobs currently running, by name; reported if shutdown has to abandon them
+in_flight_handlers = collections.Counter()
+
+def log_timing(func):
+    """
+    Decorator for handlers and jobs: logs the handler name and duration as
+    structured fields. Callback-query (vote) updates are sampled at
+    VOTE_LOG_SAMPLE_RATE unless they are slower than SLOW_HANDLER_SECONDS.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        update = args[0] if args and isinstance(args[0], Update) else None
+        started = time_module.perf_counter()
+        in_flight_handlers[func.__name__] += 1
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            in_flight_handlers[func.__name__] -= 1
+            duration = time_module.perf_counter() - started
+            is_vote = update is not None and update.callback_query is not None
+            is_slow = duration > SLOW_HANDLER_SECONDS
+            if not is_vote or is_slow or random.random() < VOTE_LOG_SAMPLE_RATE:
+                fields = update_log_fields(update)
+                fields['handler'] = func.__name__
+                fields['duration_ms'] = round(duration * 1000, 2)
+                if is_vote and not is_slow:
+                    fields['sample_rate'] = VOTE_LOG_SAMPLE_RATE
+                logger.log(logging.WARNING if is_slow else logging.INFO, "Handled %s", func.__name__, extra=fields)
+    return wrapper
+
 # --- State Persistence (File I/O) ---
 def load_state(filename: str) -> Dict[str, Any]:
-    """Loads state from a JSON file, handling int key conversion for voters."""
+    """Loads raw state from a JSON file. Returns an empty dict if it is missing or unreadable."""
     try:
         with open(filename, 'r') as f:
-            data = json.load(f)
-            if filename == STATE_FILE:
-                yes_voters_converted = {int(k): v for k, v in data.get('yes_voters', {}).items()}
-                no_voters_converted = {int(k): v for k, v in data.get('no_voters', {}).items()}
-                data['yes_voters'] = yes_voters_converted
-                data['no_voters'] = no_voters_converted
-                if 'target_chat_id' in data:
-                    data['target_chat_id'] = int(data['target_chat_id'])
-                if 'is_manual' not in data:
-                    data['is_manual'] = False
-            return data
+            return json.load(f)
     except (FileNotFoundError, json.JSONDecodeError):
-        return {} if filename == POLL_USAGE_FILE else {'is_active': False, 'yes_voters': {}, 'no_voters': {}, 'poll_message_id': None, 'target_chat_id': None, 'lunch_date': None, 'is_manual': False}
+        return {}
     except Exception as e:
-        logger.error(f"Error loading state from {filename}: {e}")
-        return {} if filename == POLL_USAGE_FILE else {'is_active': False, 'yes_voters': {}, 'no_voters': {}, 'poll_message_id': None, 'target_chat_id': None, 'lunch_date': None, 'is_manual': False}
+        logger.error("Error loading state from %s: %s", filename, e)
+        return {}
 
-def save_state(data: Dict[str, Any], filename: str):
-    """Saves state to a JSON file, handling string key conversion for voters."""
+def save_state(data: Dict[str, Any], filename: str, compact: bool = False):
+    """
+    Saves state to a JSON file. Compact mode drops indentation and whitespace.
+    Writes go to a temporary file that then replaces the target, so a process
+    killed mid-write never leaves a truncated state file behind.
+    """
     try:
-        state_to_save = data.copy()
-        if filename == STATE_FILE:
-            state_to_save['yes_voters'] = {str(k): v for k, v in data.get('yes_voters', {}).items()}
-            state_to_save['no_voters'] = {str(k): v for k, v in data.get('no_voters', {}).items()}
-            if state_to_save.get('target_chat_id') is not None:
-                state_to_save['target_chat_id'] = str(data['target_chat_id']) 
-            
-        with open(filename, 'w') as f:
-            json.dump(state_to_save, f, indent=4)
+        tmp_filename = f"{filename}.tmp"
+        # Encode in one go: json.dump() issues a write() per token, which dominates the per-vote save
+        if compact:
+            encoded = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+        else:
+            encoded = json.dumps(data, indent=4)
+        with open(tmp_filename, 'w') as f:
+            f.write(encoded)
+        os.replace(tmp_filename, filename)
     except Exception as e:
-        logger.error(f"Error saving state to {filename}: {e}")
+        logger.error("Error saving state to %s: %s", filename, e)
 
 def load_poll_state():
     """Wrapper to load global poll_state."""
-    global poll_state
     loaded_data = load_state(STATE_FILE)
     if loaded_data:
-        poll_state.update(loaded_data)
+        poll_state.load_dict(loaded_data)
 
 def save_poll_state():
     """Wrapper to save global poll_state."""
-    save_state(poll_state, STATE_FILE)
+    poll_state.revision += 1
+    save_state(poll_state.to_dict(), STATE_FILE, compact=True)
         
 def load_past_polls():
     """Loads all past poll data for history feature."""
@@ -146,7 +585,10 @@ def load_past_polls():
     return archived_polls
 
 def save_past_polls(data):
-    """Saves all past poll data for history feature."""
+    """Saves all past poll data for history feature and refreshes the in-memory copy."""
+    global past_polls_cache, past_polls_revision
+    past_polls_cache = data
+    past_polls_revision += 1
     state_to_save = {}
     for date, poll in data.items():
         state_to_save[date] = {
@@ -159,6 +601,44 @@ def save_past_polls(data):
         }
     save_state(state_to_save, PAST_POLLS_FILE)
 
+def archive_poll(date_str: str, archivable_data: Dict[str, Any]):
+    """Stores one day's results in the archive and in the cached attendance matrix."""
+    past_polls = load_past_polls()
+    past_polls[date_str] = archivable_data
+    save_past_polls(past_polls)
+    if attendance_matrix is not None:
+        attendance_matrix.add_day(date_str, archivable_data)
+
+def load_past_polls_cache():
+    """Fills the in-memory copy of the archive used by the results API."""
+    global past_polls_cache
+    past_polls_cache = load_past_polls()
+
+def reconcile_state_on_startup():
+    """
+    Repairs a poll left active by a process that died between archiving and
+    saving poll_state.json: if today's archive entry is already final, the
+    poll is marked inactive instead of being expired and archived again.
+    """
+    if not poll_state.is_active or not poll_state.lunch_date:
+        return
+    archived_poll = past_polls_cache.get(poll_state.lunch_date)
+    if archived_poll and str(archived_poll.get('status', '')).startswith('Completed'):
+        poll_state.is_active = False
+        save_poll_state()
+        logger.warning("Poll for %s was already archived (%s). Marked inactive on startup.", poll_state.lunch_date, archived_poll.get('status'))
+
+def flush_state(include_poll_state: bool = True):
+    """
+    Persists everything that is written lazily. Called at shutdown.
+    include_poll_state=False skips poll_state.json, for when a job or handler
+    was abandoned mid-way and the in-memory poll may be half-updated.
+    """
+    if include_poll_state:
+        save_poll_state()
+    save_user_directory()
+    save_chat_roster()
+
 def load_usage():
     """Loads daily /poll usage stats."""
     return load_state(POLL_USAGE_FILE)
@@ -167,6 +647,34 @@ def save_usage(data):
     """Saves daily /poll usage stats."""
     save_state(data, POLL_USAGE_FILE)
 
+def load_user_directory():
+    """Loads the user directory (user_id -> first/last/username, last seen date)."""
+    global user_directory, user_directory_dirty
+    user_directory = {int(k): v for k, v in load_state(USER_DIRECTORY_FILE).items()}
+    user_directory_dirty = False
+
+def save_user_directory():
+    """Saves the user directory if it changed since the last save."""
+    global user_directory_dirty
+    if not user_directory_dirty:
+        return
+    save_state({str(k): v for k, v in user_directory.items()}, USER_DIRECTORY_FILE, compact=True)
+    user_directory_dirty = False
+
+def load_chat_roster():
+    """Loads the target chat's member roster."""
+    global chat_roster, chat_roster_dirty
+    chat_roster = {int(uid) for uid in load_state(CHAT_ROSTER_FILE).get('members', [])}
+    chat_roster_dirty = False
+
+def save_chat_roster():
+    """Saves the roster if it changed since the last save."""
+    global chat_roster_dirty
+    if not chat_roster_dirty:
+        return
+    save_state({'members': sorted(chat_roster)}, CHAT_ROSTER_FILE, compact=True)
+    chat_roster_dirty = False
+
 
 # --- Utility Functions ---
 
@@ -193,6 +701,165 @@ def get_voter_name_full(user: User) -> str:
         return f"{user.first_name} {user.last_name}"
     return user.first_name
 
+def remember_user(user: User, seen_date: str):
+    """
+    Records a user's current names in the directory.
+    The directory is only marked dirty when the names change or on the first
+    sighting of the day, so repeated clicks do not cause extra writes.
+    A name change of a current voter bumps the poll revision (results ETag).
+    """
+    global user_directory_dirty
+    entry = {
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'username': user.username,
+        'last_seen': seen_date,
+    }
+    previous = user_directory.get(user.id)
+    if previous != entry:
+        user_directory[user.id] = entry
+        user_directory_dirty = True
+        # Live results show directory names, so a renamed voter changes the API response
+        if user.id in poll_state.votes and (previous is None or any(previous.get(k) != entry[k] for k in ('first_name', 'last_name', 'username'))):
+            poll_state.revision += 1
+
+def get_directory_name(user_id: int) -> Optional[str]:
+    """Returns a known user's display name (same format as get_voter_name), or None if never seen."""
+    entry = user_directory.get(user_id)
+    if entry is None:
+        return None
+    if entry.get('username'):
+        return f"@{entry['username']}"
+    return get_directory_name_full(user_id)
+
+def get_directory_name_full(user_id: int) -> Optional[str]:
+    """Returns the full name (First Name + Last Name) of a known user, or None if never seen."""
+    entry = user_directory.get(user_id)
+    if entry is None:
+        return None
+    if entry.get('last_name'):
+        return f"{entry['first_name']} {entry['last_name']}"
+    return entry['first_name']
+
+async def resolve_full_names(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_ids) -> Dict[int, str]:
+    """
+    Returns full names for the given users, served from the user directory.
+    Users the directory has never seen are looked up with get_chat_member,
+    at most USER_LOOKUP_CONCURRENCY at a time; failed lookups are left out.
+    """
+    full_names = {}
+    unknown_ids = []
+    for uid in user_ids:
+        name = get_directory_name_full(uid)
+        if name is None:
+            unknown_ids.append(uid)
+        else:
+            full_names[uid] = name
+
+    if not unknown_ids:
+        return full_names
+
+    semaphore = asyncio.Semaphore(USER_LOOKUP_CONCURRENCY)
+    seen_date = clock.now().strftime('%Y-%m-%d')
+
+    async def lookup(uid):
+        async with semaphore:
+            try:
+                chat_member = await context.bot.get_chat_member(chat_id, uid)
+            except Exception as e:
+                logger.error("Error looking up user %s: %s", uid, e)
+                return
+        remember_user(chat_member.user, seen_date)
+        full_names[uid] = get_voter_name_full(chat_member.user)
+
+    await asyncio.gather(*(lookup(uid) for uid in unknown_ids))
+    logger.info("Looked up %s users missing from the directory.", len(unknown_ids))
+    return full_names
+
+def get_attendance_matrix() -> AttendanceMatrix:
+    """Returns the cached attendance matrix, building it from the archive on first use."""
+    global attendance_matrix
+    if attendance_matrix is None:
+        attendance_matrix = AttendanceMatrix.from_past_polls(past_polls_cache)
+    return attendance_matrix
+
+def format_forecast_line(target_date) -> str:
+    """Returns the forecast line for the poll message, or an empty string without history."""
+    expected_yes, likelihoods = get_attendance_matrix().forecast(target_date)
+    if not likelihoods:
+        return ""
+    return FORECAST_LINE.format(round(expected_yes))
+
+def update_chat_roster(update: Update):
+    """
+    Keeps the target chat's roster current from member changes
+    (chat_member updates, join/leave service messages) and from senders
+    observed in the chat.
+    Telegram sends chat_member updates only to bots that are administrators
+    of the chat, and leave messages are not reliable in large groups; without
+    admin rights members who leave stay on the roster (and keep being
+    mentioned in reminders) until they are removed from chat_roster.json.
+    """
+    global chat_roster_dirty
+    chat = update.effective_chat
+    if chat is None or chat.id != poll_state.target_chat_id:
+        return
+
+    joined = []
+    left = []
+    if update.chat_member:
+        member = update.chat_member.new_chat_member
+        if member.status in ('member', 'administrator', 'creator') or (member.status == 'restricted' and member.is_member):
+            joined.append(member.user)
+        else:
+            left.append(member.user)
+    elif update.message and (update.message.new_chat_members or update.message.left_chat_member):
+        joined.extend(update.message.new_chat_members)
+        if update.message.left_chat_member:
+            left.append(update.message.left_chat_member)
+    elif update.effective_user:
+        joined.append(update.effective_user)
+
+    for user in joined:
+        if not user.is_bot and user.id not in chat_roster:
+            chat_roster.add(user.id)
+            chat_roster_dirty = True
+    for user in left:
+        if user.id in chat_roster:
+            chat_roster.discard(user.id)
+            chat_roster_dirty = True
+
+def format_mention(user_id: int) -> str:
+    """HTML mention of a roster member, using the user directory for the display name."""
+    entry = user_directory.get(user_id)
+    if entry and entry.get('username'):
+        return f"@{entry['username']}"
+    name = get_directory_name_full(user_id) or str(user_id)
+    return f'<a href="tg://user?id={user_id}">{html.escape(name)}</a>'
+
+def build_reminder_messages(user_ids) -> list:
+    """
+    Packs mentions into as few messages as possible, each holding at most
+    REMINDER_MENTIONS_PER_MESSAGE mentions and MAX_MESSAGE_LENGTH characters.
+    """
+    messages = []
+    current = REMINDER_HEADER
+    mentions_in_current = 0
+    for uid in user_ids:
+        mention = format_mention(uid)
+        if mentions_in_current and (
+            mentions_in_current >= REMINDER_MENTIONS_PER_MESSAGE
+            or len(current) + len(mention) + 1 > MAX_MESSAGE_LENGTH
+        ):
+            messages.append(current)
+            current = REMINDER_HEADER
+            mentions_in_current = 0
+        current += f"{mention} "
+        mentions_in_current += 1
+    if mentions_in_current:
+        messages.append(current)
+    return messages
+
 def create_poll_keyboard():
     """Generates the inline keyboard for the poll, including the Results button."""
     keyboard = [
@@ -218,30 +885,28 @@ def create_confirmation_keyboard():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def format_results_message(state_to_format=None):
+def format_results_message(state_to_format: Optional[PollState] = None):
     """Generates the formatted results string based on the provided state or current poll_state."""
     state = state_to_format if state_to_format is not None else poll_state
     
     clean_yes_option = "Иә"
     clean_no_option = "Жоқ"
     
-    # NOTE: The values in state['voters'] already use the shorter format (@username or First Name)
-    yes_list = "\n- " + "\n- ".join(state['yes_voters'].values()) if state['yes_voters'] else "Ешкім дауыс бермеді"
-    no_list = "\n- " + "\n- ".join(state['no_voters'].values()) if state['no_voters'] else "Ешкім дауыс бермеді"
-    
-    total_votes = len(state['yes_voters']) + len(state['no_voters'])
+    # NOTE: Names in the live state use the shorter format (@username or First Name)
+    yes_list = "\n- " + "\n- ".join(state.voters(True).values()) if state.yes_count else "Ешкім дауыс бермеді"
+    no_list = "\n- " + "\n- ".join(state.voters(False).values()) if state.no_count else "Ешкім дауыс бермеді"
     
     # Include the date/source
-    date_info = f"📅 Күні: *{state['lunch_date']}* (Бастауы: {'Қолмен' if state.get('is_manual') else 'Автоматты'})" if state.get('lunch_date') else "📅 Күні: *Белгісіз*"
+    date_info = f"📅 Күні: *{state.lunch_date}* (Бастауы: {'Қолмен' if state.is_manual else 'Автоматты'})" if state.lunch_date else "📅 Күні: *Белгісіз*"
     
     message = (
         f"{date_info}\n\n"
         f"Сұрақ: _{POLL_QUESTION}_\n\n"
-        f"✅ *{clean_yes_option}* ({len(state['yes_voters'])}):\n"
+        f"✅ *{clean_yes_option}* ({state.yes_count}):\n"
         f"{yes_list}\n\n"
-        f"❌ *{clean_no_option}* ({len(state['no_voters'])}):\n"
+        f"❌ *{clean_no_option}* ({state.no_count}):\n"
         f"{no_list}\n\n"
-        f"Барлығы дауыс берді: *{total_votes}*"
+        f"Барлығы дауыс берді: *{state.total_votes}*"
     )
     return message
 
@@ -251,7 +916,7 @@ async def is_admin_or_creator(context: ContextTypes.DEFAULT_TYPE, chat_id, user_
         chat_member = await context.bot.get_chat_member(chat_id, user_id)
         return chat_member.status in ['administrator', 'creator']
     except Exception as e:
-        logger.error(f"Error checking admin status: {e}")
+        logger.error("Error checking admin status: %s", e)
         return False
 
 async def get_user_role(context: ContextTypes.DEFAULT_TYPE, chat_id, user_id):
@@ -260,55 +925,85 @@ async def get_user_role(context: ContextTypes.DEFAULT_TYPE, chat_id, user_id):
         chat_member = await context.bot.get_chat_member(chat_id, user_id)
         return chat_member.status
     except Exception as e:
-        logger.error(f"Error checking user role: {e}")
+        logger.error("Error checking user role: %s", e)
         return 'member'
 
-def check_and_expire_poll() -> bool:
+def check_and_expire_poll(full_names: Optional[Dict[int, str]] = None) -> bool:
     """
     Checks if the poll is currently expired. Archives results if expired.
+    Voters are archived under full_names if given, otherwise under their
+    full names from the user directory.
     Returns True if the poll was active and is now expired, False otherwise.
     """
-    if not poll_state['is_active'] or not poll_state['lunch_date']:
+    if not poll_state.is_active or not poll_state.lunch_date:
         return False
 
     try:
-        now_kz = datetime.now(KAZAKHSTAN_TZ)
-        poll_date_dt = datetime.strptime(poll_state['lunch_date'], '%Y-%m-%d').date()
+        now_kz = clock.now()
+        poll_date_dt = datetime.strptime(poll_state.lunch_date, '%Y-%m-%d').date()
 
         # Check if today is the lunch day and time is past POLL_END_TIME (excluding tzinfo for comparison), 
         # OR if today is past the lunch day
         is_past_end_time = (now_kz.date() == poll_date_dt and now_kz.time() > POLL_END_TIME.replace(tzinfo=None)) or (now_kz.date() > poll_date_dt)
 
         if is_past_end_time:
-            poll_state['is_active'] = False
+            poll_state.is_active = False
             
             # --- ARCHIVE RESULTS ---
-            archivable_data = {
-                'yes_voters': poll_state['yes_voters'],
-                'no_voters': poll_state['no_voters'],
-                'end_time': now_kz.isoformat(),
-                'status': 'Completed_AutoExpired' if not poll_state.get('is_manual') else 'Completed_ManualExpired',
-                'is_manual': poll_state.get('is_manual', False) # Save the source type
-            }
-            past_polls = load_past_polls()
-            past_polls[poll_state['lunch_date']] = archivable_data
-            save_past_polls(past_polls)
+            if full_names is None:
+                full_names = {uid: get_directory_name_full(uid) for uid in poll_state.votes}
+            archivable_data = poll_state.to_archive(
+                end_time=now_kz.isoformat(),
+                status='Completed_AutoExpired' if not poll_state.is_manual else 'Completed_ManualExpired',
+                names=full_names,
+            )
+            archive_poll(poll_state.lunch_date, archivable_data)
             # -----------------------
 
             save_poll_state()
-            logger.info(f"Poll for {poll_state['lunch_date']} automatically expired by check at {now_kz.time()}.")
+            logger.info("Poll for %s automatically expired by check at %s.", poll_state.lunch_date, now_kz.time())
             return True
         
         return False
         
     except ValueError:
         logger.error("Invalid date format stored in poll_state. Expiring poll to be safe.")
-        poll_state['is_active'] = False
+        poll_state.is_active = False
         save_poll_state()
         return True 
 
+async def expire_stale_poll(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """
+    check_and_expire_poll() for jobs and commands that can await: voters
+    missing from the user directory are looked up first, so the archive gets
+    their full names as in end_poll_job.
+    """
+    if not poll_state.is_active:
+        return False
+    full_names = await resolve_full_names(context, poll_state.target_chat_id, poll_state.votes)
+    return check_and_expire_poll(full_names)
+
+async def answer_callback_query(query, text: Optional[str] = None, show_alert: bool = False):
+    """
+    Answers a callback query. While the webhook request that delivered it is
+    still open, the answer is returned in that HTTP response instead of a
+    separate answerCallbackQuery request; otherwise it falls back to the API.
+    """
+    future = pending_inline_answers.pop(query.id, None)
+    if future is not None and not future.done():
+        payload = {'method': 'answerCallbackQuery', 'callback_query_id': query.id, 'show_alert': show_alert}
+        if text is not None:
+            payload['text'] = text
+        future.set_result(payload)
+        callback_answer_stats['inline'] += 1
+        return
+
+    callback_answer_stats['api'] += 1
+    await query.answer(text=text, show_alert=show_alert)
+
 # --- Scheduled Job Functions ---
 
+@log_timing
 async def start_poll_job(context: CallbackContext):
     """
     Starts the poll automatically (only Mon-Fri).
@@ -317,22 +1012,25 @@ async def start_poll_job(context: CallbackContext):
     
     load_poll_state() 
 
-    if poll_state['target_chat_id'] is None:
+    if poll_state.target_chat_id is None:
         logger.error("start_poll_job failed: TARGET_CHAT_ID is not set in poll_state.")
         return
 
     # 1. Get today's date and weekday in UTC+5 time
-    now_kz = datetime.now(KAZAKHSTAN_TZ)
+    now_kz = clock.now()
     current_weekday = now_kz.weekday() 
     lunch_date_str = now_kz.strftime('%Y-%m-%d')
     
     # 2. Check for Mon-Fri schedule
     if current_weekday >= 5: # Saturday or Sunday
-        logger.info(f"Scheduled job skipped: Not a weekday ({lunch_date_str}).")
+        logger.info("Scheduled job skipped: Not a weekday (%s).", lunch_date_str)
         return
         
+    # Close (and archive) a poll left over from an earlier day whose end job did not run
+    await expire_stale_poll(context)
+
     # 3. Check if active for today
-    if poll_state['is_active'] and poll_state['lunch_date'] == lunch_date_str:
+    if poll_state.is_active and poll_state.lunch_date == lunch_date_str:
         logger.info("Scheduled job skipped: Poll already active for today.")
         return
         
@@ -343,107 +1041,164 @@ async def start_poll_job(context: CallbackContext):
         return
         
     # 5. Reset state and set new parameters
-    poll_state['is_active'] = True
-    poll_state['yes_voters'] = {}
-    poll_state['no_voters'] = {}
-    poll_state['poll_message_id'] = None
-    poll_state['lunch_date'] = lunch_date_str # Set today's date
-    poll_state['is_manual'] = False # Automatically started
+    poll_state.reset(lunch_date_str, is_manual=False) # Automatically started, for today's date
     
     # 6. Construct and send poll message
     date_text = f"📅 Күні: *{lunch_date_str}*."
+    forecast_line = format_forecast_line(now_kz.date())
     full_poll_text = (
         f"{POLL_STARTED}"
         f"{date_text}\n\n"
         f"{POLL_QUESTION}"
     )
+    if forecast_line:
+        full_poll_text += f"\n\n{forecast_line}"
 
     try:
         message = await context.bot.send_message(
-            chat_id=poll_state['target_chat_id'],
+            chat_id=poll_state.target_chat_id,
             text=full_poll_text,
             reply_markup=create_poll_keyboard(), 
             parse_mode='Markdown'
         )
-        poll_state['poll_message_id'] = message.message_id
+        poll_state.poll_message_id = message.message_id
         save_poll_state()
-        logger.info(f"New automated poll started for {lunch_date_str}.")
+        logger.info("New automated poll started for %s.", lunch_date_str)
 
     except Exception as e:
-        logger.error(f"Error starting automated poll: {e}. Ensuring state is inactive.")
-        poll_state['is_active'] = False
+        logger.error("Error starting automated poll: %s. Ensuring state is inactive.", e)
+        poll_state.is_active = False
         save_poll_state()
 
 
+@log_timing
 async def end_poll_job(context: CallbackContext):
     """Ends the poll automatically at the set end time and shows results."""
     global poll_state
     
     load_poll_state() 
     
-    now_kz = datetime.now(KAZAKHSTAN_TZ)
+    now_kz = clock.now()
     today_date_str = now_kz.strftime('%Y-%m-%d')
     
-    logger.info(f"Scheduled end job triggered for {today_date_str}.")
+    logger.info("Scheduled end job triggered for %s.", today_date_str)
     
-    if poll_state['target_chat_id'] is None:
+    if poll_state.target_chat_id is None:
         logger.error("end_poll_job failed: TARGET_CHAT_ID is not set in poll_state.")
         return
 
     # Only end the poll if it is active AND it is the correct day
-    if poll_state['is_active'] and poll_state['lunch_date'] == today_date_str:
-        
-        poll_state['is_active'] = False
+    if poll_state.is_active and poll_state.lunch_date == today_date_str:
         
         # --- ARCHIVE RESULTS ---
-        archivable_data = {
-            # Use get_voter_name_full here for full history storage
-            'yes_voters': {uid: get_voter_name_full(await context.bot.get_chat_member(poll_state['target_chat_id'], uid).user) if uid in poll_state['yes_voters'] else name for uid, name in poll_state['yes_voters'].items()},
-            'no_voters': {uid: get_voter_name_full(await context.bot.get_chat_member(poll_state['target_chat_id'], uid).user) if uid in poll_state['no_voters'] else name for uid, name in poll_state['no_voters'].items()},
-            'end_time': now_kz.isoformat(),
-            'status': 'Completed_Scheduled' if not poll_state.get('is_manual') else 'Completed_Manual',
-            'is_manual': poll_state.get('is_manual', False)
-        }
+        # Full names for history storage come from the user directory, not per-voter API calls
+        full_names = await resolve_full_names(context, poll_state.target_chat_id, poll_state.votes)
+
+        # Closed only after the awaits, so an interrupted job never leaves a closed but unarchived poll
+        poll_state.is_active = False
+        archivable_data = poll_state.to_archive(
+            end_time=now_kz.isoformat(),
+            status='Completed_Scheduled' if not poll_state.is_manual else 'Completed_Manual',
+            names=full_names,
+        )
         
         # We need to format the results message based on the *current* poll_state which uses short names.
         final_results = format_results_message()
 
-        past_polls = load_past_polls()
-        past_polls[today_date_str] = archivable_data 
-        save_past_polls(past_polls)
+        archive_poll(today_date_str, archivable_data)
         # -----------------------
 
         save_poll_state()
-        logger.info(f"Poll for {today_date_str} successfully ended by scheduled job.")
+        save_user_directory()
+        logger.info("Poll for %s successfully ended by scheduled job.", today_date_str)
 
         # Announce results
         try:
             await context.bot.send_message(
-                chat_id=poll_state['target_chat_id'],
+                chat_id=poll_state.target_chat_id,
                 text=f"{POLL_ENDED_ANNOUNCEMENT}{final_results}",
                 parse_mode='Markdown'
             )
         except Exception as e:
-            logger.error(f"Error sending final results: {e}")
+            logger.error("Error sending final results: %s", e)
             
+    elif await expire_stale_poll(context):
+        # The poll belongs to an earlier day whose end job did not run; it was archived by the check
+        logger.info("End job closed a stale poll from %s.", poll_state.lunch_date)
     else:
-        logger.info(f"End job skipped. Poll not active or not for today ({poll_state.get('lunch_date')}).")
+        logger.info("End job skipped. Poll not active or not for today (%s).", poll_state.lunch_date)
         
 
 
+@log_timing
+async def prewarm_job(context: CallbackContext):
+    """
+    Runs shortly before the poll starts so the first poll message and votes
+    are served at steady-state latency: opens pooled connections to the
+    Bot API (DNS, TLS) and builds the attendance matrix if not built yet.
+    The in-memory archive is kept as is: it is authoritative while running.
+    """
+    load_poll_state()
+    get_attendance_matrix().forecast(clock.now().date())
+
+    results = await asyncio.gather(
+        *(context.bot.get_me() for _ in range(PREWARM_CONNECTIONS)), return_exceptions=True
+    )
+    failures = [r for r in results if isinstance(r, Exception)]
+    if failures:
+        logger.warning("Pre-warm: %s of %s Bot API requests failed: %s", len(failures), len(results), failures[0])
+    else:
+        logger.info("Pre-warm complete: %s Bot API connections opened.", len(results))
+
+@log_timing
+async def reminder_job(context: CallbackContext):
+    """
+    Mentions the roster members who have not voted yet, REMINDER_LEAD_MINUTES
+    before the poll closes. Non-voters are a set difference against the live
+    votes, so no per-user API calls are made. Leaving members are only
+    dropped from the roster if the bot is a chat admin (see update_chat_roster).
+    """
+    load_poll_state()
+
+    today_date_str = clock.now().strftime('%Y-%m-%d')
+    if not poll_state.is_active or poll_state.lunch_date != today_date_str or poll_state.target_chat_id is None:
+        logger.info("Reminder skipped. Poll not active for today (%s).", poll_state.lunch_date)
+        return
+
+    non_voters = chat_roster - poll_state.votes.keys()
+    if not non_voters:
+        logger.info("Reminder skipped. Everyone on the roster has voted.")
+        return
+
+    messages = build_reminder_messages(sorted(non_voters))
+    for text in messages:
+        try:
+            await context.bot.send_message(chat_id=poll_state.target_chat_id, text=text, parse_mode='HTML')
+        except Exception as e:
+            logger.error("Error sending reminder: %s", e)
+    logger.info("Reminded %s non-voters in %s messages.", len(non_voters), len(messages), extra={'chat_id': poll_state.target_chat_id})
+
+async def flush_user_data_job(context: CallbackContext):
+    """Periodically persists the user directory and chat roster if they changed."""
+    save_user_directory()
+    save_chat_roster()
+
+
 # --- Command Handlers ---
 
+@log_timing
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Sends a welcome message and explains the bot."""
     await update.message.reply_text(WELCOME_MESSAGE, parse_mode='Markdown')
 
+@log_timing
 async def results_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Sends the current voting results. Available to all users.
     """
     load_poll_state() 
     
-    target_chat_id_for_check = poll_state.get('target_chat_id') or TARGET_CHAT_ID
+    target_chat_id_for_check = poll_state.target_chat_id or TARGET_CHAT_ID
 
     # Check 1: Chat validation
     is_private_chat = update.message.chat.type == "private"
@@ -459,7 +1214,7 @@ async def results_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"{POLL_ENDED_ANNOUNCEMENT}{format_results_message()}", parse_mode='Markdown')
         return
 
-    if not poll_state['is_active']:
+    if not poll_state.is_active:
         await update.message.reply_text(NOT_ACTIVE_MESSAGE)
         return
 
@@ -467,6 +1222,7 @@ async def results_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"{RESULTS_HEADER}{results}", parse_mode='Markdown')
 
 
+@log_timing
 async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Retrieves and sends the voting results for a specific past date.
@@ -475,7 +1231,7 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # History command is accessible to all users for transparency.
     if not context.args:
         # Default to previous day if no date is specified
-        yesterday_kz = datetime.now(KAZAKHSTAN_TZ) - timedelta(days=1)
+        yesterday_kz = clock.now() - timedelta(days=1)
         target_date_str = yesterday_kz.strftime('%Y-%m-%d')
         
     else:
@@ -487,12 +1243,7 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         archived_poll = past_polls[target_date_str]
         
         # NOTE: Archived polls store FULL names, so we use them directly
-        temp_state = {
-            'yes_voters': archived_poll['yes_voters'],
-            'no_voters': archived_poll['no_voters'],
-            'lunch_date': target_date_str,
-            'is_manual': archived_poll.get('is_manual', False)
-        }
+        temp_state = PollState.from_archive(archived_poll, target_date_str)
         
         results = format_results_message(temp_state) 
         
@@ -503,12 +1254,13 @@ async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text(HISTORY_NOT_FOUND)
 
+@log_timing
 async def delete_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Allows the group creator to delete a specific day's history.
     Usage: /deletehistory YYYY-MM-DD
     """
-    target_chat_id = poll_state.get('target_chat_id')
+    target_chat_id = poll_state.target_chat_id
     if update.effective_chat.id != target_chat_id:
         await update.message.reply_text(ONLY_IN_TARGET_CHAT)
         return
@@ -529,18 +1281,21 @@ async def delete_history_command(update: Update, context: ContextTypes.DEFAULT_T
     if date_to_delete in past_polls:
         past_polls.pop(date_to_delete)
         save_past_polls(past_polls)
+        if attendance_matrix is not None:
+            attendance_matrix.remove_day(date_to_delete)
         await update.message.reply_text(HISTORY_DELETED_SUCCESS.format(date_to_delete), parse_mode='Markdown')
     else:
         await update.message.reply_text(HISTORY_NOT_FOUND)
 
 
+@log_timing
 async def manual_poll_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Allows group administrators to manually start/restart the poll, respecting usage limits.
     """
     load_poll_state()
     user_id = update.effective_user.id
-    target_chat_id = poll_state.get('target_chat_id')
+    target_chat_id = poll_state.target_chat_id
     
     # Check 1: Must be in the target group
     if update.effective_chat.id != target_chat_id:
@@ -561,7 +1316,7 @@ async def manual_poll_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     MAX_CREATOR_USES = 5
     
     usage_data = load_usage()
-    now_kz = datetime.now(KAZAKHSTAN_TZ)
+    now_kz = clock.now()
     lunch_date_str = now_kz.strftime('%Y-%m-%d')
     
     today_usage = usage_data.get(lunch_date_str, {})
@@ -576,13 +1331,16 @@ async def manual_poll_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return
 
+    # Close (and archive) a poll left over from an earlier day before it can be overwritten
+    await expire_stale_poll(context)
+
     # Check 4: Check if already started by automated job
-    if poll_state['is_active'] and poll_state['lunch_date'] == lunch_date_str and not poll_state.get('is_manual', False):
+    if poll_state.is_active and poll_state.lunch_date == lunch_date_str and not poll_state.is_manual:
         await update.message.reply_text(MANUAL_POLL_LOCKED_MESSAGE, parse_mode='Markdown')
         return
 
     # Check 5: If a poll is already manually active for today, ask for confirmation to restart (and delete votes)
-    if poll_state['is_active'] and poll_state['lunch_date'] == lunch_date_str and poll_state.get('is_manual', False):
+    if poll_state.is_active and poll_state.lunch_date == lunch_date_str and poll_state.is_manual:
         await update.message.reply_text(
             CONFIRMATION_MESSAGE, 
             reply_markup=create_confirmation_keyboard(),
@@ -603,12 +1361,7 @@ async def start_manual_poll(context: ContextTypes.DEFAULT_TYPE, chat_id: int, lu
     global poll_state
     
     # We must first fetch the full user list and names if needed, but for start/restart, we wipe votes.
-    poll_state['is_active'] = True
-    poll_state['yes_voters'] = {}
-    poll_state['no_voters'] = {}
-    poll_state['poll_message_id'] = None
-    poll_state['lunch_date'] = lunch_date_str 
-    poll_state['is_manual'] = True 
+    poll_state.reset(lunch_date_str, is_manual=True)
 
     # 1. Construct and send poll message
     date_text = f"📅 Күні: *{lunch_date_str}*."
@@ -625,7 +1378,7 @@ async def start_manual_poll(context: ContextTypes.DEFAULT_TYPE, chat_id: int, lu
             reply_markup=create_poll_keyboard(), 
             parse_mode='Markdown'
         )
-        poll_state['poll_message_id'] = message.message_id
+        poll_state.poll_message_id = message.message_id
         save_poll_state()
         
         # 2. Update Usage Count
@@ -640,11 +1393,14 @@ async def start_manual_poll(context: ContextTypes.DEFAULT_TYPE, chat_id: int, lu
         confirmation_msg = RESTART_CONFIRMED if is_restart else MANUAL_POLL_STARTED
         await context.bot.send_message(chat_id=chat_id, text=confirmation_msg, parse_mode='Markdown')
         
-        logger.info(f"New manual poll started/restarted for {lunch_date_str} by user {user_id}. Uses: {user_uses_today + 1}")
+        logger.info(
+            "New manual poll started/restarted for %s by user %s. Uses: %s", lunch_date_str, user_id, user_uses_today + 1,
+            extra={'chat_id': chat_id, 'user_id': user_id},
+        )
 
     except Exception as e:
-        logger.error(f"Error starting manual poll: {e}. Ensuring state is inactive.")
-        poll_state['is_active'] = False
+        logger.error("Error starting manual poll: %s. Ensuring state is inactive.", e)
+        poll_state.is_active = False
         save_poll_state()
         await context.bot.send_message(chat_id=chat_id, text="❌ Қолмен дауыс беруді бастау кезінде қате пайда болды.")
 
@@ -653,14 +1409,14 @@ async def poll_confirmation_handler(update: Update, context: ContextTypes.DEFAUL
     """Handles the confirmation callback for restarting an active poll."""
     query = update.callback_query
     
-    await query.answer() # Acknowledge the query immediately
+    await answer_callback_query(query) # Acknowledge the query immediately
     
     action = query.data.split(':')[1]
     user_id = query.from_user.id
     chat_id = query.message.chat_id
     
     load_poll_state()
-    now_kz = datetime.now(KAZAKHSTAN_TZ)
+    now_kz = clock.now()
     lunch_date_str = now_kz.strftime('%Y-%m-%d')
 
     # Check 1: Ensure only the person who is an admin/creator can confirm/cancel
@@ -670,23 +1426,18 @@ async def poll_confirmation_handler(update: Update, context: ContextTypes.DEFAUL
         return
 
     # Check 2: Ensure the confirmation is still relevant for the current date
-    if poll_state['lunch_date'] != lunch_date_str:
+    if poll_state.lunch_date != lunch_date_str:
         await query.message.edit_text("❌ Растау уақыты өтіп кетті немесе жаңа дауыс беру басталды.")
         return
 
     if action == 'restart':
         # 1. Archive current poll data 
-        current_data = {
-            # Use current short names for archival, as full names would require another API call
-            'yes_voters': poll_state['yes_voters'],
-            'no_voters': poll_state['no_voters'],
-            'end_time': now_kz.isoformat(),
-            'status': 'Restarted_DeletedVotes', # Status to indicate votes were deleted
-            'is_manual': poll_state.get('is_manual', False)
-        }
-        past_polls = load_past_polls()
-        past_polls[lunch_date_str] = current_data
-        save_past_polls(past_polls)
+        # Use current short names for archival, as full names would require another API call
+        current_data = poll_state.to_archive(
+            end_time=now_kz.isoformat(),
+            status='Restarted_DeletedVotes', # Status to indicate votes were deleted
+        )
+        archive_poll(lunch_date_str, current_data)
         
         # 2. Edit the confirmation message to show action taken
         await query.edit_message_text(f"{CONFIRMATION_MESSAGE}\n\n{RESTART_CONFIRMED}", parse_mode='Markdown')
@@ -699,8 +1450,22 @@ async def poll_confirmation_handler(update: Update, context: ContextTypes.DEFAUL
         await query.edit_message_text(f"{CONFIRMATION_MESSAGE}\n\n{RESTART_CANCELED}", parse_mode='Markdown')
 
 
+# --- Passive User Tracking ---
+
+async def track_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Runs before all other handlers. Records the sender of every update in the
+    user directory and keeps the target chat's roster current.
+    """
+    user = update.effective_user
+    if user is not None and not user.is_bot:
+        remember_user(user, clock.now().strftime('%Y-%m-%d'))
+    update_chat_roster(update)
+
+
 # --- Callback Query Handler (Button Clicks) ---
 
+@log_timing
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles button clicks (Yes/No votes and Results button)."""
     query = update.callback_query
@@ -718,10 +1483,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- Results Button Logic (show_results) ---
     if query.data == 'show_results':
         
-        has_voted = user_id in poll_state['yes_voters'] or user_id in poll_state['no_voters']
+        has_voted = poll_state.has_voted(user_id)
         
         if not has_voted:
-            await query.answer(text=VOTER_ONLY_ALERT, show_alert=True)
+            await answer_callback_query(query, text=VOTER_ONLY_ALERT, show_alert=True)
             return
             
         results_text = format_results_message()
@@ -745,7 +1510,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             alert_content = alert_content[:MAX_ALERT_LENGTH]
         # ==========================================================
 
-        await query.answer(text=alert_content, show_alert=True)
+        await answer_callback_query(query, text=alert_content, show_alert=True)
         return
 
     # --- Voting Logic (vote_yes/vote_no) ---
@@ -753,51 +1518,294 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Check 2: Automatic Expiry Check
     is_expired = check_and_expire_poll()
     if is_expired:
-        await query.answer(text=POLL_ENDED_BY_TIME, show_alert=True)
+        await answer_callback_query(query, text=POLL_ENDED_BY_TIME, show_alert=True)
         return
 
     # Check 3: Poll must be active
-    if not poll_state['is_active']:
-        await query.answer(text=POLL_INACTIVE_ALERT, show_alert=True)
+    if not poll_state.is_active:
+        await answer_callback_query(query, text=POLL_INACTIVE_ALERT, show_alert=True)
         return
 
-    # Use the new, shorter display name for the state
-    user_name_display = get_voter_name(user) 
+    # The results list shows names from the user directory; make sure this voter is in it
+    if user_id not in user_directory:
+        remember_user(user, clock.now().strftime('%Y-%m-%d'))
     vote_type = query.data 
-    vote_changed = False 
     
     # --- IMPLEMENTATION OF "LAST VOTE COUNTS" ---
-    if vote_type == 'vote_yes':
-        if user_id in poll_state['no_voters']:
-            poll_state['no_voters'].pop(user_id) 
-            vote_changed = True
-        
-        if user_id in poll_state['yes_voters']:
-            await query.answer(text=f"Сіздің дауысыңыз *Иә* болып тіркелген.", show_alert=False) 
-            return 
-            
-        poll_state['yes_voters'][user_id] = user_name_display
-        
-    elif vote_type == 'vote_no':
-        if user_id in poll_state['yes_voters']:
-            poll_state['yes_voters'].pop(user_id) 
-            vote_changed = True
-        
-        if user_id in poll_state['no_voters']:
-            await query.answer(text=f"Сіздің дауысыңыз *Жоқ* болып тіркелген.", show_alert=False)
-            return 
-            
-        poll_state['no_voters'][user_id] = user_name_display
+    is_yes = vote_type == 'vote_yes'
+    previous_vote = poll_state.cast_vote(user_id, is_yes)
 
+    if previous_vote is is_yes:
+        already_text = "Сіздің дауысыңыз *Иә* болып тіркелген." if is_yes else "Сіздің дауысыңыз *Жоқ* болып тіркелген."
+        await answer_callback_query(query, text=already_text, show_alert=False)
+        return
+
+    vote_changed = previous_vote is not None
     save_poll_state()
-    load_poll_state() # Reload just to be sure state is up to date
     
     confirmation_message = VOTE_CHANGED_ALERT if vote_changed else VOTE_REGISTERED_ALERT
-    await query.answer(text=confirmation_message, show_alert=False)
+    await answer_callback_query(query, text=confirmation_message, show_alert=False)
+
+
+# --- HTTP Server (Webhook + Results API) ---
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    """Receives updates from Telegram and hands them to the Application's update queue."""
+    SUPPORTED_METHODS = ("POST",)
+
+    def initialize(self, bot_app: Application):
+        self.bot_app = bot_app
+
+    async def post(self):
+        if not accepting_updates:
+            # Telegram redelivers on non-2xx, so the update reaches the next instance instead of being lost
+            raise tornado.web.HTTPError(HTTPStatus.SERVICE_UNAVAILABLE)
+
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.bot_app.bot)
+        except Exception as e:
+            logger.error("Could not parse incoming webhook update: %s", e)
+            raise tornado.web.HTTPError(HTTPStatus.BAD_REQUEST)
+
+        if not update:
+            self.set_status(HTTPStatus.OK)
+            return
+
+        self.bot_app.bot.insert_callback_data(update)
+        if update.callback_query is None:
+            await self.bot_app.update_queue.put(update)
+            self.set_status(HTTPStatus.OK)
+            return
+
+        # Hold the response briefly so the handler's answer can ride back on it
+        query_id = update.callback_query.id
+        future = asyncio.get_running_loop().create_future()
+        pending_inline_answers[query_id] = future
+        await self.bot_app.update_queue.put(update)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), INLINE_ANSWER_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            # After this the handler answers through the API instead
+            pending_inline_answers.pop(query_id, None)
+
+        self.set_status(HTTPStatus.OK)
+        if future.done():
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(future.result(), ensure_ascii=False))
+        else:
+            callback_answer_stats['inline_timeout'] += 1
+
+
+class ResultsApiHandler(tornado.web.RequestHandler):
+    """
+    Base class for the read-only results API.
+    Responses are built only from in-memory state and carry a revision-based
+    ETag, so a client polling an unchanged poll gets a body-less 304.
+    """
+    SUPPORTED_METHODS = ("GET",)
+
+    # Identifies this process in ETags, since revisions restart from zero on boot
+    BOOT_ID = f"{int(time_module.time()):x}"
+
+    def prepare(self):
+        # Header only: a query-string token would end up in proxy and access logs
+        auth_header = self.request.headers.get("Authorization", "")
+        token = auth_header[len("Bearer "):] if auth_header.startswith("Bearer ") else ""
+        if not API_TOKEN or not hmac.compare_digest(token.encode(), API_TOKEN.encode()):
+            raise tornado.web.HTTPError(HTTPStatus.UNAUTHORIZED)
+
+    def compute_etag(self):
+        # ETags are set explicitly from revisions; skip tornado's body hashing
+        return None
+
+    def write_versioned(self, revision_tag: str, build_payload):
+        """Replies 304 if the client's ETag matches revision_tag, otherwise builds and writes the payload."""
+        self.set_header("ETag", f'"{self.BOOT_ID}-{revision_tag}"')
+        self.set_header("Cache-Control", "no-cache")
+        if self.check_etag_header():
+            self.set_status(HTTPStatus.NOT_MODIFIED)
+            return
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write(json.dumps(build_payload(), ensure_ascii=False))
+
+
+class CurrentResultsApiHandler(ResultsApiHandler):
+    """GET /api/results: tallies of the current (or most recent) poll."""
+    def get(self):
+        self.write_versioned(f"poll-{poll_state.revision}", poll_state.to_api_dict)
+
+
+class HistoryApiHandler(ResultsApiHandler):
+    """GET /api/history[/YYYY-MM-DD]: archived days, or one archived day."""
+    def get(self, date_str: Optional[str] = None):
+        if date_str is None:
+            self.write_versioned(f"archive-{past_polls_revision}", lambda: {'dates': sorted(past_polls_cache)})
+            return
+
+        archived_poll = past_polls_cache.get(date_str)
+        if archived_poll is None:
+            raise tornado.web.HTTPError(HTTPStatus.NOT_FOUND)
+
+        def build_payload():
+            payload = PollState.from_archive(archived_poll, date_str).to_api_dict()
+            payload.update(end_time=archived_poll.get('end_time'), status=archived_poll.get('status'))
+            return payload
+
+        self.write_versioned(f"archive-{past_polls_revision}", build_payload)
+
+
+class ForecastApiHandler(ResultsApiHandler):
+    """GET /api/forecast: today's expected "yes" count and per-user likelihoods."""
+    def get(self):
+        today = clock.now().date()
+
+        def build_payload():
+            matrix = get_attendance_matrix()
+            expected_yes, likelihoods = matrix.forecast(today)
+            return {
+                'date': today.isoformat(),
+                'expected_yes': round(expected_yes, 2),
+                'users': [
+                    {'user_id': uid, 'name': matrix.names.get(uid), 'likelihood': round(p, 3)}
+                    for uid, p in sorted(likelihoods.items(), key=lambda item: -item[1])
+                ],
+            }
+
+        self.write_versioned(f"forecast-{today.isoformat()}-{past_polls_revision}", build_payload)
+
+
+class MetricsApiHandler(ResultsApiHandler):
+    """GET /api/metrics: how callback queries were answered since startup."""
+    def get(self):
+        inline = callback_answer_stats['inline']
+        total = inline + callback_answer_stats['api']
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write(json.dumps({
+            'callback_answers_inline': inline,
+            'callback_answers_api': callback_answer_stats['api'],
+            'inline_timeouts': callback_answer_stats['inline_timeout'],
+            'inline_share': round(inline / total, 4) if total else None,
+        }))
+
+
+class WebhookServerApplication(tornado.web.Application):
+    """
+    tornado Application with a quieter access log. The default one logs every
+    request at INFO with its full URI, which contains BOT_TOKEN (the webhook
+    path). Here successful requests are not logged at all, and failed ones are
+    logged without the query string and with the token redacted.
+    """
+    def log_request(self, handler: tornado.web.RequestHandler):
+        status = handler.get_status()
+        if status < 400:
+            return
+        path = handler.request.path.replace(BOT_TOKEN, "<bot-token>") if BOT_TOKEN else handler.request.path
+        log_method = logger.warning if status < 500 else logger.error
+        log_method("HTTP %s %s %s (%.1f ms)", status, handler.request.method, path, 1000.0 * handler.request.request_time())
+
+
+def create_web_app(application: Application) -> tornado.web.Application:
+    """Builds the tornado app serving the Telegram webhook and, if API_TOKEN is set, the results API."""
+    routes = [
+        (rf"/{re.escape(BOT_TOKEN)}/?", TelegramWebhookHandler, {'bot_app': application}),
+    ]
+    if API_TOKEN:
+        routes += [
+            (r"/api/results/?", CurrentResultsApiHandler),
+            (r"/api/history/?", HistoryApiHandler),
+            (r"/api/history/(\d{4}-\d{2}-\d{2})/?", HistoryApiHandler),
+            (r"/api/forecast/?", ForecastApiHandler),
+            (r"/api/metrics/?", MetricsApiHandler),
+        ]
+    else:
+        logger.info("API_TOKEN is not set. The results API is disabled.")
+    return WebhookServerApplication(routes)
+
+
+async def shutdown_gracefully(application: Application, server) -> bool:
+    """
+    Stops accepting updates, drains queued updates, running handlers and jobs
+    within SHUTDOWN_TIMEOUT_SECONDS, then flushes state to disk (poll state
+    only if everything finished). Returns True if everything was drained before the deadline.
+    """
+    global accepting_updates
+    accepting_updates = False
+    server.stop()
+
+    started = time_module.perf_counter()
+    logger.info(
+        "Shutdown started. Draining %s queued updates and running jobs (deadline %ss).",
+        application.update_queue.qsize(), SHUTDOWN_TIMEOUT_SECONDS,
+    )
+
+    # Application.stop() processes every update queued so far and waits for running jobs
+    stop_task = asyncio.create_task(application.stop())
+    done, _ = await asyncio.wait({stop_task}, timeout=SHUTDOWN_TIMEOUT_SECONDS)
+    drained = stop_task in done
+    duration_ms = round((time_module.perf_counter() - started) * 1000, 2)
+
+    if drained:
+        logger.info("Drained all in-flight updates and jobs.", extra={'duration_ms': duration_ms})
+    else:
+        abandoned = application.update_queue.qsize()
+        unfinished = sorted((+in_flight_handlers).elements())
+        stop_task.cancel()
+        logger.warning(
+            "Shutdown deadline hit. Abandoned %s queued updates and unfinished handlers/jobs: %s.", abandoned, unfinished,
+            extra={'duration_ms': duration_ms},
+        )
+
+    # An abandoned handler or job may have left the poll half-updated (e.g. closed but
+    # not yet archived). Every completed vote and archive step already saved it, so
+    # keep the last saved poll_state.json and flush only the lazily saved files.
+    flush_state(include_poll_state=drained)
+    logger.info("State flushed to disk.", extra={'poll_state_saved': drained})
+    return drained
+
+
+async def run_webhook_server(application: Application, webhook_url: str):
+    """Runs the Application behind our own webhook server until SIGINT/SIGTERM, then shuts down gracefully."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    await application.start()
+    logger.info("JobQueue scheduler started successfully.")
+
+    server = create_web_app(application).listen(PORT, address="0.0.0.0")
+    await application.bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES)
+    logger.info("Bot started in Webhook mode, listening on port %s.", PORT)
+
+    await stop_event.wait()
+
+    if await shutdown_gracefully(application, server):
+        await application.shutdown()
 
 
 # --- Application Initialization (Webhook Mode) ---
 
+def create_bot_request() -> HTTPXRequest:
+    """Builds the Bot API HTTP client with the configured pool, keep-alive, HTTP version and timeouts."""
+    return HTTPXRequest(
+        connection_pool_size=BOT_HTTP_POOL_SIZE,
+        http_version=BOT_HTTP_VERSION,
+        connect_timeout=BOT_HTTP_CONNECT_TIMEOUT,
+        read_timeout=BOT_HTTP_READ_TIMEOUT,
+        write_timeout=BOT_HTTP_WRITE_TIMEOUT,
+        pool_timeout=BOT_HTTP_POOL_TIMEOUT,
+        httpx_kwargs={
+            'limits': httpx.Limits(
+                max_connections=BOT_HTTP_POOL_SIZE,
+                max_keepalive_connections=BOT_HTTP_POOL_SIZE,
+                keepalive_expiry=BOT_HTTP_KEEPALIVE_SECONDS,
+            ),
+        },
+    )
+
 def main():
     """
     Starts the bot in Webhook mode and sets up the automatic scheduling (JobQueue).
@@ -815,21 +1823,34 @@ def main():
 
     try:
         TARGET_CHAT_ID = int(TARGET_CHAT_ID_RAW)
-        # Load state after TARGET_CHAT_ID is ready
+        # Load state after TARGET_CHAT_ID is ready. The directory comes first:
+        # loading the poll looks up which voters it already knows.
+        load_user_directory()
         load_poll_state()
-        poll_state['target_chat_id'] = TARGET_CHAT_ID 
+        poll_state.target_chat_id = TARGET_CHAT_ID 
+        load_chat_roster()
     except ValueError:
-        logger.error(f"FATAL: TARGET_CHAT_ID environment variable '{TARGET_CHAT_ID_RAW}' is not a valid integer.")
+        logger.error("FATAL: TARGET_CHAT_ID environment variable '%s' is not a valid integer.", TARGET_CHAT_ID_RAW)
         return
         
-    # 2. Create the Application
-    application = Application.builder().token(BOT_TOKEN).build()
+    load_past_polls_cache()
+    reconcile_state_on_startup()
+
+    # 2. Create the Application (updates arrive through our own webhook server, so no Updater)
+    application = Application.builder().token(BOT_TOKEN).request(create_bot_request()).updater(None).build()
     job_queue = application.job_queue
 
     # 3. Schedule and Start JobQueue 
     if job_queue:
         WEEKDAY_SCHEDULE = (0, 1, 2, 3, 4) 
         
+        job_queue.run_daily(
+            prewarm_job,
+            PREWARM_TIME,
+            days=WEEKDAY_SCHEDULE,
+            name='daily_prewarm'
+        )
+        
         job_queue.run_daily(
             start_poll_job, 
             POLL_START_TIME, 
@@ -845,14 +1866,27 @@ def main():
             name='daily_poll_end'
         )
         
-        logger.info(f"Jobs scheduled for start (Mon-Fri) at {POLL_START_TIME.strftime('%H:%M')} and end (Daily) at {POLL_END_TIME.strftime('%H:%M')} UTC+5.")
-
-        job_queue.start()
-        logger.info("JobQueue scheduler started successfully.")
+        if REMINDER_LEAD_MINUTES > 0:
+            job_queue.run_daily(
+                reminder_job,
+                REMINDER_TIME,
+                days=WEEKDAY_SCHEDULE,
+                name='daily_non_voter_reminder'
+            )
+        
+        job_queue.run_repeating(
+            flush_user_data_job,
+            interval=USER_DIRECTORY_FLUSH_SECONDS,
+            name='user_data_flush'
+        )
+        
+        logger.info("Jobs scheduled for start (Mon-Fri) at %s and end (Daily) at %s UTC+5.", POLL_START_TIME.strftime('%H:%M'), POLL_END_TIME.strftime('%H:%M'))
     else:
         logger.error("FATAL ERROR: JobQueue could not be initialized. Please ensure 'python-telegram-bot[job-queue]' is installed.")
 
     # 4. Register handlers
+    # Group -1 runs before the command/callback handlers for every update
+    application.add_handler(TypeHandler(Update, track_user_handler), group=-1)
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("results", results_command))
     application.add_handler(CommandHandler("history", history_command))
@@ -860,16 +1894,9 @@ def main():
     application.add_handler(CommandHandler("poll", manual_poll_command)) 
     application.add_handler(CallbackQueryHandler(button_handler))
 
-    # 5. Start Webhook
+    # 5. Start Webhook (JobQueue is started together with the Application)
     webhook_url = f"{RENDER_EXTERNAL_URL}/{BOT_TOKEN}"
-    
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path=BOT_TOKEN,
-        webhook_url=webhook_url
-    )
-    logger.info(f"Bot started in Webhook mode, listening on port {PORT}. Webhook URL: {webhook_url}")
+    asyncio.run(run_webhook_server(application, webhook_url))
 
 if __name__ == '__main__':
     main()
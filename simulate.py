@@ -0,0 +1,293 @@
+"""
+Virtual-clock simulation of the lunch poll schedule.
+
+Replays a number of weeks of the daily schedule (start job, votes, end job)
+against lunch_bot's real handlers and jobs, with a VirtualClock instead of
+the wall clock and an in-process fake of the Telegram Bot API. State files
+are written to a temporary directory.
+
+It checks state and archive invariants after every simulated day and
+reports the per-day cost of the jobs as the archive grows.
+
+Usage: python simulate.py --weeks 26 --voters 50
+
+The defaults (52 weeks, 50 users) take about ten seconds. Longer replays
+grow faster than linearly, because the bot rewrites the whole archive
+(past_polls.json) on every end job: --weeks 156 takes about a minute with
+50 users and about four minutes with 200. The report shows how much of
+the end-job time those rewrites take.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time as time_module
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from telegram import CallbackQuery, Chat, Message, Update, User
+
+import lunch_bot
+from lunch_bot import KAZAKHSTAN_TZ, POLL_START_TIME, POLL_END_TIME, PollState, VirtualClock
+
+SIM_CHAT_ID = -1000000000001
+ADMIN_USER_ID = 1
+
+
+class SimBot:
+    """Answers the Bot API calls made by lunch_bot from memory."""
+    def __init__(self):
+        self.next_message_id = 1
+        self.sent_messages = 0
+        self.answered_queries = 0
+        self.chat_member_calls = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent_messages += 1
+        self.next_message_id += 1
+        return SimpleNamespace(message_id=self.next_message_id, chat_id=chat_id, text=text)
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        self.answered_queries += 1
+        return True
+
+    async def get_chat_member(self, chat_id, user_id):
+        self.chat_member_calls += 1
+        status = 'creator' if user_id == ADMIN_USER_ID else 'member'
+        return SimpleNamespace(status=status, user=User(user_id, f"User{user_id}", False))
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.bot = SimBot()
+        self.context = SimpleNamespace(bot=self.bot, args=[])
+        self.clock = VirtualClock(datetime.combine(args.start, POLL_START_TIME))
+        self.users = [
+            User(uid, f"First{uid}", False, last_name=f"Last{uid}" if uid % 3 else None, username=f"user{uid}" if uid % 2 else None)
+            for uid in range(ADMIN_USER_ID, args.voters + 1)
+        ]
+        self.next_update_id = 1
+        # Insertion-ordered set, so a violation that persists is reported once
+        self.failures = {}
+        self.day_costs = []
+        self.archive_save_ms = 0.0
+        # Final vote per user for each polled day, as the voters cast them
+        self.expected = {}
+        self.unverified = {}
+
+    def at(self, day, hour, minute=0, second=0):
+        return datetime(day.year, day.month, day.day, hour, minute, second, tzinfo=KAZAKHSTAN_TZ)
+
+    def make_callback_update(self, user: User, data: str) -> Update:
+        self.next_update_id += 1
+        query = CallbackQuery(str(self.next_update_id), user, chat_instance="sim", data=data)
+        update = Update(self.next_update_id, callback_query=query)
+        update.set_bot(self.bot)
+        query.set_bot(self.bot)
+        return update
+
+    def make_command_update(self, user: User, text: str) -> Update:
+        self.next_update_id += 1
+        chat = Chat(SIM_CHAT_ID, Chat.SUPERGROUP)
+        message = Message(self.next_update_id, self.clock.now(), chat, from_user=user, text=text)
+        update = Update(self.next_update_id, message=message)
+        for obj in (update, message, chat):
+            obj.set_bot(self.bot)
+        return update
+
+    async def click(self, user: User, data: str):
+        update = self.make_callback_update(user, data)
+        # Group -1 handler runs first, as in the real Application
+        await lunch_bot.track_user_handler(update, self.context)
+        await lunch_bot.button_handler(update, self.context)
+
+    async def run_job(self, job, moment) -> float:
+        self.clock.set(moment)
+        started = time_module.perf_counter()
+        await job(self.context)
+        return (time_module.perf_counter() - started) * 1000
+
+    async def simulate_day(self, day):
+        args = self.args
+        is_weekday = day.weekday() < 5
+        day_str = day.isoformat()
+        cost = {'date': day_str, 'start_ms': 0.0, 'end_ms': 0.0, 'votes': 0}
+
+        if is_weekday and self.rng.random() < args.manual_rate:
+            # Admin starts the poll by hand with /poll before the scheduled job
+            self.clock.set(self.at(day, 7, 30))
+            update = self.make_command_update(self.users[0], '/poll')
+            await lunch_bot.track_user_handler(update, self.context)
+            await lunch_bot.manual_poll_command(update, self.context)
+
+        cost['start_ms'] = await self.run_job(lunch_bot.start_poll_job, self.at(day, POLL_START_TIME.hour, POLL_START_TIME.minute))
+
+        if is_weekday and lunch_bot.poll_state.is_active and lunch_bot.poll_state.lunch_date == day_str:
+            final_votes = {}
+            window_seconds = (POLL_END_TIME.hour - POLL_START_TIME.hour) * 3600 - 1
+            voters = self.rng.sample(self.users, k=int(len(self.users) * self.rng.uniform(0.5, 0.95)))
+            clicks = []
+            for user in voters:
+                for _ in range(1 + (self.rng.random() < args.change_rate)):
+                    clicks.append((self.rng.randrange(window_seconds), user, self.rng.choice(('vote_yes', 'vote_no'))))
+            for offset, user, data in sorted(clicks, key=lambda click: click[0]):
+                self.clock.set(self.at(day, POLL_START_TIME.hour) + timedelta(seconds=offset))
+                await self.click(user, data)
+                final_votes[user.id] = data == 'vote_yes'
+                cost['votes'] += 1
+            self.expected[day_str] = final_votes
+            self.unverified[day_str] = final_votes
+            self.check_live_state(day_str, final_votes)
+
+        if self.rng.random() < args.missed_end_rate:
+            cost['end_ms'] = None
+        else:
+            cost['end_ms'] = await self.run_job(lunch_bot.end_poll_job, self.at(day, POLL_END_TIME.hour, POLL_END_TIME.minute))
+
+        if is_weekday and self.rng.random() < args.late_vote_rate:
+            # A vote after the poll closed must never be counted
+            self.clock.set(self.at(day, POLL_END_TIME.hour, 30))
+            await self.click(self.rng.choice(self.users), 'vote_yes')
+
+        self.check_after_day(day)
+        self.day_costs.append(cost)
+
+    def fail(self, day_str, message):
+        self.failures.setdefault(f"{day_str}: {message}")
+
+    def check_live_state(self, day_str, final_votes):
+        state = lunch_bot.poll_state
+        yes_expected = sum(final_votes.values())
+        if (state.yes_count, state.no_count) != (yes_expected, len(final_votes) - yes_expected):
+            self.fail(day_str, f"tallies {state.yes_count}/{state.no_count} != expected {yes_expected}/{len(final_votes) - yes_expected}")
+        if state.yes_count != sum(state.votes.values()) or state.total_votes != len(state.votes):
+            self.fail(day_str, "maintained counters drifted from the vote map")
+
+        on_disk = PollState()
+        on_disk.load_dict(lunch_bot.load_state(lunch_bot.STATE_FILE))
+        if on_disk.to_dict() != state.to_dict():
+            self.fail(day_str, "poll_state.json differs from in-memory state")
+
+    def check_after_day(self, day, recheck_all=False):
+        """
+        Checks the archive against the votes cast. Each polled day is checked
+        in the in-memory archive until it is found there; recheck_all
+        re-verifies every day and compares past_polls.json with it.
+        """
+        state = lunch_bot.poll_state
+        past_polls = lunch_bot.past_polls_cache
+        if recheck_all and lunch_bot.load_past_polls() != past_polls:
+            self.fail(day.isoformat(), "past_polls.json differs from the in-memory archive")
+
+        # Every day whose poll has closed must be archived with the votes as cast
+        days_to_check = self.expected if recheck_all else dict(self.unverified)
+        for day_str, final_votes in days_to_check.items():
+            if state.is_active and state.lunch_date == day_str:
+                continue
+            self.unverified.pop(day_str, None)
+            archived = past_polls.get(day_str)
+            if archived is None:
+                self.fail(day_str, "closed poll is missing from the archive")
+                continue
+            if set(archived['yes_voters']) & set(archived['no_voters']):
+                self.fail(day_str, "a user is archived as both yes and no")
+            archived_votes = {uid: True for uid in archived['yes_voters']}
+            archived_votes.update((uid, False) for uid in archived['no_voters'])
+            if archived_votes != final_votes:
+                self.fail(day_str, "archived votes differ from the votes cast")
+            archived_names = {**archived['yes_voters'], **archived['no_voters']}
+            if any(name != lunch_bot.get_directory_name_full(int(uid)) for uid, name in archived_names.items()):
+                self.fail(day_str, "archived names are not the voters' full names")
+
+        if state.is_active and state.lunch_date < day.isoformat():
+            # Tolerated only until the next check or job closes it
+            if self.args.missed_end_rate == 0:
+                self.fail(day.isoformat(), f"poll for {state.lunch_date} still active")
+
+    def timed_save_past_polls(self, save_past_polls):
+        """Wraps lunch_bot.save_past_polls to measure the archive rewrites."""
+        def wrapper(data):
+            started = time_module.perf_counter()
+            save_past_polls(data)
+            self.archive_save_ms += (time_module.perf_counter() - started) * 1000
+        return wrapper
+
+    async def run(self):
+        lunch_bot.clock = self.clock
+        lunch_bot.save_past_polls = self.timed_save_past_polls(lunch_bot.save_past_polls)
+        lunch_bot.poll_state.target_chat_id = SIM_CHAT_ID
+        lunch_bot.load_past_polls_cache()
+
+        day = self.args.start
+        for _ in range(self.args.weeks * 7):
+            await self.simulate_day(day)
+            day += timedelta(days=1)
+
+        # Close out the final day so every simulated vote ends up archived
+        self.clock.set(self.at(day, 0))
+        lunch_bot.check_and_expire_poll()
+        self.check_after_day(day, recheck_all=True)
+
+    def report(self):
+        print(f"Simulated {self.args.weeks} weeks ({len(self.day_costs)} days), {self.args.voters} users, seed {self.args.seed}.")
+        print(f"Archived days: {len(lunch_bot.past_polls_cache)}. Bot API calls: "
+              f"{self.bot.sent_messages} messages, {self.bot.answered_queries} callback answers, "
+              f"{self.bot.chat_member_calls} get_chat_member.")
+        print()
+        print(f"{'week':>5} {'archive':>8} {'votes/day':>10} {'start ms':>9} {'end ms':>9} {'end max':>9}")
+        for week_start in range(0, len(self.day_costs), 7 * self.args.report_every):
+            week = self.day_costs[week_start:week_start + 7 * self.args.report_every]
+            weekdays = [c for c in week if datetime.strptime(c['date'], '%Y-%m-%d').weekday() < 5]
+            end_costs = [c['end_ms'] for c in weekdays if c['end_ms'] is not None]
+            archive_size = sum(1 for d in lunch_bot.past_polls_cache if d <= week[-1]['date'])
+            print(f"{week_start // 7 + 1:>5} {archive_size:>8} "
+                  f"{sum(c['votes'] for c in weekdays) / max(len(weekdays), 1):>10.1f} "
+                  f"{sum(c['start_ms'] for c in weekdays) / max(len(weekdays), 1):>9.2f} "
+                  f"{sum(end_costs) / max(len(end_costs), 1):>9.2f} "
+                  f"{max(end_costs, default=0.0):>9.2f}")
+        end_total_ms = sum(c['end_ms'] for c in self.day_costs if c['end_ms'] is not None)
+        print()
+        print(f"Archive rewrites (save_past_polls, whole file with indent=4): {self.archive_save_ms:.0f} ms, "
+              f"vs {end_total_ms:.0f} ms in end jobs. At multi-year archive sizes they make up most of the end-job cost.")
+        print()
+        if self.failures:
+            print(f"{len(self.failures)} invariant violations:")
+            for failure in list(self.failures)[:50]:
+                print(f"  - {failure}")
+        else:
+            print("All invariants held.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay the lunch poll schedule on a virtual clock.")
+    parser.add_argument("--weeks", type=int, default=52)
+    parser.add_argument("--voters", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--start", type=lambda s: datetime.strptime(s, '%Y-%m-%d').date(),
+                        default=datetime(2025, 1, 6).date(), help="first simulated day (YYYY-MM-DD)")
+    parser.add_argument("--change-rate", type=float, default=0.1, help="share of voters who click twice")
+    parser.add_argument("--missed-end-rate", type=float, default=0.05, help="share of days whose end job does not run")
+    parser.add_argument("--late-vote-rate", type=float, default=0.1, help="share of weekdays with a vote after closing")
+    parser.add_argument("--manual-rate", type=float, default=0.05, help="share of weekdays started with /poll")
+    parser.add_argument("--report-every", type=int, default=4, help="weeks per report row")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    os.chdir(tempfile.mkdtemp(prefix="lunch_bot_sim_"))
+
+    simulation = Simulation(args)
+    asyncio.run(simulation.run())
+    simulation.report()
+    sys.exit(1 if simulation.failures else 0)
+
+
+if __name__ == '__main__':
+    main()